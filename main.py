@@ -1,5 +1,5 @@
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware     # ★ 新增
 from contextlib import asynccontextmanager
 import json, sqlite3, threading, logging, os, time
@@ -7,8 +7,11 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 import paho.mqtt.client as mqtt
 import uvicorn
-from utils.bpm import calculate_bpm_once
-from utils.motion_detection import motion_detection
+from typing import Optional
+from utils.csi import CSI_LEN, CsiWindow
+from utils.ingest import IngestValidator
+from utils.export import check_available, stream_export
+from utils.scheduler import AdaptiveScheduler, BPM_WINDOW_MAX
 
 # ---------- 日志配置 ----------
 LOG_FILE = "mqtt_csi.log"
@@ -22,7 +25,7 @@ logging.basicConfig(
 bpm_ready = False
 
 # ---------- 1. 初始化数据库 ----------
-DB_PATH = "csi_data.db"
+DB_PATH = os.environ.get("CSI_DB_PATH", "csi_data.db")
 SQL_CREATE_TABLE = """
 CREATE TABLE IF NOT EXISTS csi_frame (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -43,9 +46,19 @@ CREATE TABLE IF NOT EXISTS csi_frame (
 """
 db = sqlite3.connect(DB_PATH, check_same_thread=False)
 db.execute(SQL_CREATE_TABLE)
+db.execute("CREATE INDEX IF NOT EXISTS idx_csi_frame_received ON csi_frame (received_at_utc)")
 db.commit()
 
+# /bpm 与 /motion 共享同一个解码窗口，每帧只解析一次；按设备自适应调度计算
+csi_window = CsiWindow(DB_PATH, max_seconds=BPM_WINDOW_MAX)
+# 入库前去重、检测缺口 / 重启，并维护每个设备的链路统计
+validator = IngestValidator()
+scheduler = AdaptiveScheduler(csi_window, validator)
+
 # ---------- 2. MQTT 逻辑 ----------
+MQTT_HOST = os.environ.get("MQTT_HOST", "192.168.137.60")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", "1883"))
+
 def on_connect(client, _userdata, _flags, rc):
     print(f"[MQTT] Connected, rc={rc}")
     client.subscribe("/esp32/#")
@@ -54,21 +67,34 @@ def on_message(_client, _userdata, msg):
     try:
         payload = json.loads(msg.payload.decode(errors="replace"))
     except (UnicodeDecodeError, json.JSONDecodeError):
+        validator.bad_payload()
         return
 
     now_iso = datetime.now(ZoneInfo("Asia/Shanghai")).strftime("%Y-%m-%d %H:%M:%S")
     rows = []
-    for f in payload.get("frames", []):
+    frames = payload.get("frames", []) if isinstance(payload, dict) else None
+    if not isinstance(frames, list):
+        validator.bad_payload()
+        return
+    for f in frames:
         try:
-            rows.append((
+            # csi 必须是整数数组；长度不等于 CSI_LEN 的帧照常入库（其他固件 / 带宽），只计数
+            csi = f["csi"]
+            if not isinstance(csi, list) or not all(isinstance(x, int) for x in csi):
+                raise ValueError("bad csi")
+            row = (
                 now_iso, f["mac"], int(f["rssi"]), int(f["rate"]),
                 int(f["noise_floor"]), int(f["fft_gain"]), int(f["agc_gain"]),
                 int(f["channel"]), int(f["timestamp"]), int(f["sig_len"]),
                 int(f["rx_state"]), int(f["first_word_invalid"]),
-                json.dumps(f["csi"], separators=(",", ":"))
-            ))
+                json.dumps(csi, separators=(",", ":"))
+            )
         except (KeyError, TypeError, ValueError):
+            mac = f.get("mac") if isinstance(f, dict) else None
+            validator.malformed(mac if isinstance(mac, str) else None)
             continue
+        if validator.accept(row[1], row[8], now_iso, other_len=len(csi) != CSI_LEN):
+            rows.append(row)
 
     if rows:
         db.executemany(
@@ -84,7 +110,7 @@ def start_mqtt_loop():
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
-    client.connect("192.168.137.60", 1883)
+    client.connect(MQTT_HOST, MQTT_PORT)
     client.loop_forever()
 
 # ---------- 3. FastAPI + Lifespan ----------
@@ -120,21 +146,51 @@ app.add_middleware(
 def get_status():
     return {"status": "running", "db": DB_PATH}
 
+@app.get("/health")
+def get_health():
+    return {"code": 200, "data": validator.summary()}
+
+@app.get("/export")
+def get_export(start: Optional[str] = None, end: Optional[str] = None,
+               mac: Optional[str] = None, format: str = "arrow"):
+    """按时间范围 [start, end) 流式导出 csi_frame，format 为 arrow（IPC stream）或 parquet。"""
+    for t in (start, end):
+        if t is not None:
+            try:
+                datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                return JSONResponse(status_code=400, content={"message": f"Invalid time: {t}, expected %Y-%m-%d %H:%M:%S"})
+    if format not in ("arrow", "parquet"):
+        return JSONResponse(status_code=400, content={"message": "format must be arrow or parquet"})
+    try:
+        check_available()
+    except RuntimeError as e:
+        return JSONResponse(status_code=501, content={"message": str(e)})
+    media_type = "application/vnd.apache.arrow.stream" if format == "arrow" else "application/vnd.apache.parquet"
+    filename = f"csi_frame.{'arrows' if format == 'arrow' else 'parquet'}"
+    return StreamingResponse(stream_export(DB_PATH, start, end, mac, fmt=format), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
 @app.get("/bpm")
-def get_bpm():
+def get_bpm(mac: Optional[str] = None):
     if not bpm_ready:
         return JSONResponse(status_code=503, content={"message": "BPM not ready. Please wait 20 seconds after startup."})
-    now, fs, bpm = calculate_bpm_once(db_path=DB_PATH, window_length_sec=20)
-    if bpm == 0:
+    res = scheduler.bpm(mac)
+    if res is not None and res["skipped"] == "motion":
+        return JSONResponse(status_code=204, content={"message": "Motion detected, breathing rate unavailable."})
+    if res is None or res["bpm"] == 0:
         return JSONResponse(status_code=204, content={"message": "Not enough CSI data."})
-    return {"code": 200, "data": {"bpm": bpm, "timestamp": now.strftime('%Y-%m-%d %H:%M:%S'), "sampling_rate": round(fs, 2)}}
+    return {"code": 200, "data": {"bpm": res["bpm"], "timestamp": res["timestamp"], "sampling_rate": res["sampling_rate"],
+                                  "confidence": res["confidence"], "window_sec": res["window_sec"],
+                                  "frame_id": res["frame_id"]}}
 
 @app.get("/motion")
-def get_motion():
-    res = motion_detection()
+def get_motion(mac: Optional[str] = None):
+    res = scheduler.motion(mac)
     if res is None:
         return JSONResponse(status_code=204, content={"message": "Not enough CSI data."})
-    return {"code": 200, "data": {"motion": res}}
+    return {"code": 200, "data": {"motion": res["motion"], "confidence": res["confidence"], "timestamp": res["timestamp"],
+                                  "frame_id": res["frame_id"]}}
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay recorded CSI captures through the live receiver pipeline.  —  回放已录制的
+CSI 数据（csi_data.db 或 CSI_DATA CSV），按 ESP32 固件 mqtt_send_csi_data 的格式
+打包成 {"frames":[...]} 批次，以实时或 N 倍速发送，并统计从发布到 /bpm 可见的延迟。
+
+Examples:
+    # 发到本地 broker，由正在运行的 main.py 接收（MQTT_HOST=127.0.0.1 启动；需指定接收端的数据库以探测可见性）
+    python replay.py csi_data.db --broker 127.0.0.1 --speed 10 --macs 50 \
+        --receiver-db /srv/csi/csi_data.db --bpm-url http://127.0.0.1:8000/bpm
+
+    # 进程内回放：直接调用 main.on_message 与调度器，不需要 broker
+    python replay.py capture.csv --inproc --speed 5 --workdir /tmp/replay
+"""
+
+import argparse
+import csv
+import json
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from utils.csi import CSI_LEN
+
+TOPIC = "/esp32/csi_batch"
+BATCH_LEN = 2          # 与固件 CSI_BATCH_SEND_LEN 保持一致
+DT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# ---------- 1. 读取录制数据 ----------
+def load_frames_from_db(db_path):
+    """
+    按 id 顺序逐行读取 csi_frame，返回 (offset_sec, frame_dict) 列表。
+    各设备时钟互不相关，offset 按设备分别计算：设备第一帧以 received_at_utc 对齐到
+    公共时间轴，之后累加该设备自己的 csi_timestamp 间隔（微秒，uint32 会回绕），
+    跳变过大时退回该设备的 received_at_utc（秒级）。
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.execute(
+        "SELECT received_at_utc, mac, rssi, rate, noise_floor, fft_gain, agc_gain, "
+        "channel, csi_timestamp, sig_len, rx_state, first_word_invalid, csi_json "
+        "FROM csi_frame ORDER BY id ASC"
+    )
+    frames = []
+    t0 = None
+    devices = {}    # mac -> (offset, prev_ts, prev_recv)
+    for row in cursor:
+        try:
+            csi = json.loads(row[12])
+        except json.JSONDecodeError:
+            continue
+        recv = _parse_time(row[0])
+        if t0 is None:
+            t0 = recv
+        mac, ts = row[1], row[8]
+        if mac not in devices:
+            offset = (recv - t0).total_seconds() if recv is not None and t0 is not None else 0.0
+        else:
+            offset, prev_ts, prev_recv = devices[mac]
+            delta = ((ts - prev_ts) % (1 << 32)) / 1e6
+            if delta > 10.0 and recv is not None and prev_recv is not None:
+                delta = max((recv - prev_recv).total_seconds(), 0.0)
+            offset += delta
+        devices[mac] = (offset, ts, recv)
+        frames.append((max(offset, 0.0), {
+            "mac": mac, "rssi": row[2], "rate": row[3], "noise_floor": row[4],
+            "fft_gain": row[5], "agc_gain": row[6], "channel": row[7],
+            "timestamp": ts, "sig_len": row[9], "rx_state": row[10],
+            "first_word_invalid": row[11], "csi": csi,
+        }))
+    conn.close()
+    return frames
+
+
+def load_frames_from_csv(csv_path):
+    """
+    读取 CSI_DATA CSV（与 utils.bpm.parse_csi_file 相同的格式：倒数第二列为 CSI 数组，
+    最后一列为时间），但不按长度过滤，由 check_csi_len 统一检查。CSV 中只有秒级时间，
+    同一秒内的帧均匀摊开；缺失的元数据字段填 0。
+    """
+    rows = []
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        for row in csv.reader(f, delimiter=',', quotechar='"'):
+            if not row or not row[0].startswith("CSI_DATA"):
+                continue
+            dt = _parse_time(row[-1].strip()[:19])
+            if dt is None:
+                continue
+            try:
+                csi = [int(x) for x in row[-2].strip('[]').split(',')]
+            except ValueError:
+                continue
+            rows.append((dt, csi))
+    if not rows:
+        return []
+
+    # 统计每一秒内的帧数，用于均匀分布 offset
+    per_sec = {}
+    for dt, _ in rows:
+        per_sec[dt] = per_sec.get(dt, 0) + 1
+    t0 = rows[0][0]
+
+    frames = []
+    seen = {}
+    for dt, csi in rows:
+        k = seen.get(dt, 0)
+        seen[dt] = k + 1
+        offset = (dt - t0).total_seconds() + k / per_sec[dt]
+        frames.append((offset, {
+            "mac": "00:00:00:00:00:00", "rssi": 0, "rate": 0, "noise_floor": 0,
+            "fft_gain": 0, "agc_gain": 0, "channel": 0,
+            "timestamp": int(offset * 1e6) % (1 << 32), "sig_len": 0, "rx_state": 0,
+            "first_word_invalid": 0, "csi": csi,
+        }))
+    return frames
+
+
+def check_csi_len(frames):
+    """
+    接收端（CsiWindow / calculate_bpm_once）只使用 CSI_LEN 个值的帧，其他长度的帧
+    入库后永远不会出现在 /bpm 中。这里把它们剔除并打印各长度的计数。
+    """
+    lengths = {}
+    for _, f in frames:
+        lengths[len(f["csi"])] = lengths.get(len(f["csi"]), 0) + 1
+    kept = [x for x in frames if len(x[1]["csi"]) == CSI_LEN]
+    if len(kept) < len(frames):
+        print(f"[REPLAY] Dropped {len(frames) - len(kept)} frame(s) whose CSI length is not "
+              f"{CSI_LEN} (receiver ignores them); lengths seen: {lengths}")
+    return kept
+
+
+def _parse_time(s):
+    for fmt in (DT_FORMAT, "%Y-%m-%dT%H:%M:%S.%f%z"):
+        try:
+            dt = datetime.strptime(s, fmt)
+        except (TypeError, ValueError):
+            continue
+        if dt.tzinfo is not None:
+            # 与 parse_csi_file_v2 一致，统一转为本地时间，避免 aware / naive 混算
+            dt = dt.astimezone().replace(tzinfo=None)
+        return dt
+    return None
+
+
+# ---------- 2. 打包批次 ----------
+def sim_mac(i):
+    """第 i 个模拟设备的 MAC（本地管理地址段 02:xx）。"""
+    return "02:00:00:%02x:%02x:%02x" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+
+
+def build_schedule(frames, n_macs=1, batch_len=BATCH_LEN):
+    """
+    与固件一致，每批只包含同一设备的 batch_len 帧，按最后一帧的 offset 排程；
+    n_macs > 1 时每个源设备复制 n_macs 份，各用一个模拟 MAC。
+    返回按时间排序的 (offset, mac, batch) 列表。
+    """
+    by_mac = {}
+    for item in frames:
+        by_mac.setdefault(item[1]["mac"], []).append(item)
+
+    schedule = []
+    for g, dev_frames in enumerate(by_mac.values()):
+        for m in range(n_macs):
+            mac = sim_mac(m * len(by_mac) + g) if n_macs > 1 else None
+            for i in range(0, len(dev_frames) - batch_len + 1, batch_len):
+                chunk = dev_frames[i:i + batch_len]
+                batch = [dict(f, mac=mac) if mac else f for _, f in chunk]
+                schedule.append((chunk[-1][0], batch[-1]["mac"], batch))
+    schedule.sort(key=lambda x: x[0])
+    return schedule
+
+
+def encode_batch(batch):
+    """与固件一致的紧凑 JSON：{"frames":[{...,"csi":[...]}]}。"""
+    return json.dumps({"frames": batch}, separators=(",", ":")).encode()
+
+
+# ---------- 3. 发布端 ----------
+class BrokerSink:
+    """通过 MQTT broker 发布，QoS 1 与固件一致。"""
+
+    def __init__(self, host, port):
+        import paho.mqtt.client as mqtt
+        self.client = mqtt.Client()
+        self.client.connect(host, port)
+        self.client.loop_start()
+
+    def publish(self, payload):
+        self.client.publish(TOPIC, payload, qos=1)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class _Msg:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class InProcessSink:
+    """不经过 broker，直接调用 main.on_message；通过 CSI_DB_PATH 让 main 在 workdir 下建库。"""
+
+    def __init__(self, workdir):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.makedirs(workdir, exist_ok=True)
+        # 不切换工作目录：main 与模型加载使用的相对路径保持不变
+        os.environ["CSI_DB_PATH"] = os.path.join(os.path.abspath(workdir), "csi_data.db")
+        import main
+        main.bpm_ready = True
+        self.main = main
+
+    def publish(self, payload):
+        self.main.on_message(None, None, _Msg(TOPIC, payload))
+
+    def close(self):
+        pass
+
+
+# ---------- 4. 延迟探测 ----------
+POLL_INTERVAL = 0.005
+
+
+class LatencyProbe:
+    """
+    记录 publish -> 帧写入接收端数据库 -> /bpm 结果覆盖该帧 的端到端延迟。
+    探测在 workers 个线程中并发进行，不阻塞发布循环。每个探测记录出队时刻：
+    出队等待超过 2 个轮询周期的探测，其可见时刻只能给出上界，不计入延迟分位数，
+    而是单独作为 backlog 报告。
+    bpm_fn(mac) 返回 /bpm 结果的 frame_id（无结果时为 None）。帧入库后持续轮询，
+    直到 frame_id 不小于该帧的行 id 才算一次探测；超时未覆盖的计入 timeouts，
+    bpm_fn 抛出的异常计入 errors。未提供 bpm_fn 时只测量入库延迟。
+    """
+
+    def __init__(self, receiver_db, bpm_fn=None, timeout=10.0, workers=4):
+        self.receiver_db = receiver_db
+        self.bpm_fn = bpm_fn
+        self.timeout = timeout
+        self.latencies = []
+        self.waits = []
+        self.backlogged = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._q = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, t_pub, mac, csi_timestamp):
+        self._q.put((t_pub, mac, csi_timestamp))
+
+    def _run(self):
+        conn = sqlite3.connect(self.receiver_db)
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+            t_pub, mac, csi_ts = item
+            wait = time.perf_counter() - t_pub
+            deadline = t_pub + self.timeout
+            row_id = None
+            while True:
+                if row_id is None:
+                    try:
+                        row_id = conn.execute(
+                            "SELECT MAX(id) FROM csi_frame WHERE mac = ? AND csi_timestamp = ?",
+                            (mac, csi_ts)).fetchone()[0]
+                    except sqlite3.OperationalError:
+                        pass        # 接收端尚未建表或数据库被锁
+                covered = row_id is not None and self.bpm_fn is None
+                if row_id is not None and self.bpm_fn is not None:
+                    try:
+                        frame_id = self.bpm_fn(mac)
+                    except Exception:
+                        with self._lock:
+                            self.errors += 1
+                        break
+                    covered = frame_id is not None and frame_id >= row_id
+                if covered:
+                    latency = time.perf_counter() - t_pub
+                    with self._lock:
+                        self.waits.append(wait)
+                        if wait > 2 * POLL_INTERVAL:
+                            self.backlogged += 1
+                        else:
+                            self.latencies.append(latency)
+                    break
+                if time.perf_counter() > deadline:
+                    with self._lock:
+                        self.timeouts += 1
+                    break
+                time.sleep(POLL_INTERVAL)
+        conn.close()
+
+    def close(self):
+        for _ in self._threads:
+            self._q.put(None)
+        for t in self._threads:
+            t.join()
+
+    @staticmethod
+    def _pcts(values):
+        v = sorted(values)
+
+        def pct(p):
+            return round(v[min(int(p * len(v)), len(v) - 1)] * 1000, 2)
+        return {"p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+                "max_ms": round(v[-1] * 1000, 2)}
+
+    def report(self):
+        res = {"probes": len(self.latencies), "timeouts": self.timeouts, "errors": self.errors}
+        if self.latencies:
+            res.update(self._pcts(self.latencies))
+        res["backlog"] = {"probes": self.backlogged}
+        if self.waits:
+            res["backlog"].update(self._pcts(self.waits))
+        return res
+
+
+def http_bpm(url, timeout=10.0):
+    """返回查询 /bpm 的 bpm_fn；204（运动 / 数据不足）或连接失败时返回 None，继续轮询。"""
+    def query(mac):
+        sep = "&" if "?" in url else "?"
+        try:
+            with urllib.request.urlopen(f"{url}{sep}mac={urllib.parse.quote(mac)}", timeout=timeout) as resp:
+                body = resp.read()
+                if resp.status != 200:
+                    return None
+        except (urllib.error.URLError, OSError):
+            return None
+        return json.loads(body)["data"]["frame_id"]
+    return query
+
+
+def inproc_bpm(main):
+    """进程内的 bpm_fn；直接取调度器结果，运动时跳过 BPM 的结果同样带有 frame_id。"""
+    def query(mac):
+        res = main.scheduler.bpm(mac)
+        return None if res is None else res["frame_id"]
+    return query
+
+
+# ---------- 5. 回放主循环 ----------
+def replay(schedule, sink, probe, speed=1.0, probe_every=10):
+    """按 offset / speed 的节奏发布；speed <= 0 表示尽可能快。"""
+    n_frames = 0
+    t_start = time.perf_counter()
+    for i, (offset, mac, batch) in enumerate(schedule):
+        if speed > 0:
+            wait = t_start + offset / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        t_pub = time.perf_counter()
+        sink.publish(encode_batch(batch))
+        n_frames += len(batch)
+        if probe is not None and i % probe_every == 0:
+            probe.submit(t_pub, mac, batch[-1]["timestamp"])
+    elapsed = time.perf_counter() - t_start
+    return {"batches": len(schedule), "frames": n_frames,
+            "elapsed_s": round(elapsed, 2),
+            "frames_per_s": round(n_frames / elapsed, 1) if elapsed > 0 else 0.0}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay CSI captures through the receiver pipeline")
+    ap.add_argument("source", help="csi_data.db 或 CSI_DATA CSV 文件")
+    ap.add_argument("--speed", type=float, default=1.0, help="回放倍速，0 表示不限速")
+    ap.add_argument("--macs", type=int, default=1, help="每个源设备复制的模拟设备数量")
+    ap.add_argument("--batch", type=int, default=BATCH_LEN, help="每批帧数")
+    ap.add_argument("--broker", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=1883)
+    ap.add_argument("--inproc", action="store_true", help="进程内调用 main.on_message，不走 broker")
+    ap.add_argument("--workdir", default=None, help="进程内模式下 main.py 的工作目录（存放 csi_data.db）")
+    ap.add_argument("--receiver-db", default=None, help="broker 模式下接收端数据库路径，用于探测可见性")
+    ap.add_argument("--bpm-url", default=None, help="broker 模式下 /bpm 接口地址")
+    ap.add_argument("--probe-every", type=int, default=10, help="每 N 批探测一次延迟")
+    args = ap.parse_args()
+
+    source = os.path.abspath(args.source)
+    if source.endswith(".db"):
+        frames = load_frames_from_db(source)
+    else:
+        frames = load_frames_from_csv(source)
+    frames = check_csi_len(frames)
+    if len(frames) < args.batch:
+        print(f"[REPLAY] Not enough {CSI_LEN}-value CSI frames in {source}, nothing to replay")
+        return
+    schedule = build_schedule(frames, n_macs=args.macs, batch_len=args.batch)
+    print(f"[REPLAY] {len(frames)} frames x {args.macs} MAC(s) -> {len(schedule)} batches, "
+          f"span {max(o for o, _ in frames):.1f}s, speed {args.speed}x")
+
+    if args.inproc:
+        sink = InProcessSink(args.workdir or tempfile.mkdtemp(prefix="csi_replay_"))
+        probe = LatencyProbe(os.path.abspath(sink.main.DB_PATH), inproc_bpm(sink.main))
+    else:
+        sink = BrokerSink(args.broker, args.port)
+        probe = None
+        if args.receiver_db:
+            probe = LatencyProbe(args.receiver_db, http_bpm(args.bpm_url) if args.bpm_url else None)
+
+    try:
+        stats = replay(schedule, sink, probe, speed=args.speed, probe_every=args.probe_every)
+    finally:
+        sink.close()
+        if probe is not None:
+            probe.close()
+    if probe is not None:
+        stats["latency"] = probe.report()
+    print("[REPLAY]", json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
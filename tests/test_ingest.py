@@ -0,0 +1,104 @@
+from utils.ingest import DEDUP_WINDOW, REBOOT_BACKWARD_US, TS_WRAP, IngestValidator
+
+MAC = "aa:bb:cc:dd:ee:ff"
+AT = "2025-05-01 12:00:00"
+STEP = 10_000       # 100 Hz
+
+
+def feed(v, timestamps):
+    return [v.accept(MAC, ts, AT) for ts in timestamps]
+
+
+def stats(v):
+    return v.devices[MAC]
+
+
+def test_wrap_is_not_a_reboot():
+    v = IngestValidator()
+    start = TS_WRAP - 5 * STEP
+    feed(v, [start + i * STEP for i in range(5)])
+    # 回绕后时间戳从很小的值继续，间隔不变
+    feed(v, [(start + i * STEP) % TS_WRAP for i in range(5, 10)])
+    st = stats(v)
+    assert st.reboots == 0
+    assert st.gaps == 0
+    assert st.accepted == 10
+    assert st.last_ts == (start + 9 * STEP) % TS_WRAP
+
+
+def test_large_backward_jump_is_a_reboot():
+    v = IngestValidator()
+    feed(v, [100_000_000 + i * STEP for i in range(5)])
+    feed(v, [1_000 + i * STEP for i in range(5)])
+    st = stats(v)
+    assert st.reboots == 1
+    assert st.gaps == 0
+    assert st.last_ts == 1_000 + 4 * STEP
+    assert [e["type"] for e in v.events(MAC)] == ["reboot"]
+
+
+def test_reboot_right_after_reboot():
+    v = IngestValidator()
+    feed(v, [100_000_000 + i * STEP for i in range(5)])
+    # 第一次重启后只跑了约 3 s 又重启
+    feed(v, [REBOOT_BACKWARD_US + 1_000_000 + i * STEP for i in range(3)])
+    feed(v, [500 + i * STEP for i in range(3)])
+    st = stats(v)
+    assert st.reboots == 2
+    assert st.gaps == 0
+    assert st.last_ts == 500 + 2 * STEP
+
+
+def test_out_of_order_does_not_move_last_ts():
+    v = IngestValidator()
+    feed(v, [i * STEP for i in range(1, 6)])
+    assert feed(v, [7 * STEP, 6 * STEP]) == [True, True]
+    st = stats(v)
+    assert st.last_ts == 7 * STEP
+    # 下一帧与 last_ts 相隔一个正常间隔，不应被判为缺口
+    feed(v, [8 * STEP])
+    assert st.gaps == 0
+    assert st.reboots == 0
+    assert st.last_ts == 8 * STEP
+
+
+def test_gap_estimates_lost_frames():
+    v = IngestValidator()
+    feed(v, [i * STEP for i in range(1, 11)])
+    feed(v, [15 * STEP])
+    st = stats(v)
+    assert st.gaps == 1
+    assert st.lost_estimate == 4
+    assert v.events(MAC)[-1]["lost"] == 4
+
+
+def test_duplicate_within_window_is_dropped():
+    v = IngestValidator()
+    feed(v, [i * STEP for i in range(1, 6)])
+    assert feed(v, [3 * STEP]) == [False]
+    st = stats(v)
+    assert st.duplicates == 1
+    assert st.accepted == 5
+
+
+def test_dedup_evicts_oldest_timestamp():
+    v = IngestValidator()
+    timestamps = [i * STEP for i in range(1, DEDUP_WINDOW + 2)]
+    feed(v, timestamps)
+    st = stats(v)
+    assert len(st._recent) == DEDUP_WINDOW
+    # 最早的时间戳已被挤出窗口，重发会被当作新帧；最近的仍被去重
+    assert feed(v, [timestamps[0]]) == [True]
+    assert feed(v, [timestamps[-1]]) == [False]
+    assert st.duplicates == 1
+    assert len(st._recent) == len(st._recent_set) == DEDUP_WINDOW
+
+
+def test_malformed_without_mac_is_counted_globally():
+    v = IngestValidator()
+    v.malformed()
+    v.malformed(MAC)
+    summary = v.summary()
+    assert summary["malformed_frames"] == 1
+    assert summary["devices"][MAC]["malformed"] == 1
+    assert summary["devices"][MAC]["accepted"] == 0
@@ -5,8 +5,7 @@ import numpy as np
 import time
 from datetime import datetime, timedelta, timezone
 from scipy.signal import savgol_filter
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+from utils.csi import CSI_LEN, decode_csi_json, iq_to_amplitude
 
 socketio = None
 
@@ -25,6 +24,10 @@ def update_websocket(time_str, median_bpm, avg_bpm_int):
         })
 
 def animate_bpm(dict_cal_plot, dt_format="%Y-%m-%d %H:%M:%S"):
+    # matplotlib 只在画图时导入，避免拖慢服务启动
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
     # 对时间键按照时间顺序排序，并转换为 datetime 对象
     sorted_times = sorted(dict_cal_plot.keys(), key=lambda t: datetime.strptime(t, dt_format))
     times_dt = [datetime.strptime(t, dt_format) for t in sorted_times]
@@ -148,16 +151,21 @@ def csi_to_complex_v2(csi_signals):
         complex_signals.append(real + 1j * np.array(imag))
     return complex_signals
 
+def savgol_window(fs):
+    """Savitzky-Golay 滤波窗口长度：约 1 秒，至少 3，且为奇数。"""
+    window_length = int(1 * fs)
+    if window_length < 3:
+        window_length = 3
+    if window_length % 2 == 0:
+        window_length += 1
+    return window_length
+
 def pre_process_signal(signal, fs):
     """
     去直流、使用中值滤波平滑信号（代替带通滤波）。
     """
     # Savitzky-Golay filter
-    window_length = int(1 * fs)  
-    if window_length < 3:
-        window_length = 3
-    if window_length % 2 == 0:
-        window_length += 1
+    window_length = savgol_window(fs)
     smooth_signal = savgol_filter(signal, window_length, polyorder=2)
     return smooth_signal
 
@@ -206,11 +214,12 @@ def process_breathing_rate_sliding_window(complex_signals, timestamps, window_le
         
         # fs
         fs = len(window_signals) / (window_end - window_start).total_seconds()
-        n_subcarriers = window_signals[0].shape[0]
+        amplitude = np.abs(np.asarray(window_signals)).astype(np.float32)
+        n_subcarriers = amplitude.shape[1]
         bpm_list = []
         # for each subcarrier
         for sub_idx in range(n_subcarriers):
-            subcarrier_series = np.array([np.abs(s[sub_idx]) for s in window_signals])
+            subcarrier_series = amplitude[:, sub_idx]
             if len(subcarrier_series) < 2:
                 continue
             proc = pre_process_signal(subcarrier_series, fs)
@@ -234,81 +243,110 @@ def process_breathing_rate_sliding_window(complex_signals, timestamps, window_le
     return results, dict_cal_int, dict_cal_plot
 
 
-def calculate_bpm_once(db_path="csi_data.db", window_length_sec=15):
+def calculate_bpm_once(db_path="csi_data.db", window_length_sec=15, window=None):
     """
     从数据库中提取最近 window_length_sec 秒的数据，返回当前时间、采样率、BPM。
+    传入共享的 CsiWindow 时直接复用其中已解码的振幅矩阵。
     """
     dt_format = "%Y-%m-%d %H:%M:%S"
     now = datetime.now()
-    window_start = now - timedelta(seconds=window_length_sec)
-    window_start_str = window_start.strftime(dt_format)
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    query = ("SELECT received_at_utc, csi_json FROM csi_frame "
-             "WHERE received_at_utc >= ? ORDER BY received_at_utc ASC")
-    cursor.execute(query, (window_start_str,))
-    rows = cursor.fetchall()
-    conn.close()
-
-    csi_signals = []
-    timestamps = []
-
-    for row in rows:
-        ts = row[0]
-        csi_json_str = row[1]
-        try:
-            csi_list = json.loads(csi_json_str)
-        except Exception as e:
-            print("JSON decode error:", e)
-            continue
-        if len(csi_list) != 114:
-            continue
-        csi_signals.append(np.array(csi_list))
-        timestamps.append(ts)
 
-    if not csi_signals:
+    if window is not None:
+        timestamps, amplitude = window.get(window_length_sec, now)
+    else:
+        window_start = now - timedelta(seconds=window_length_sec)
+        window_start_str = window_start.strftime(dt_format)
+
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        query = ("SELECT received_at_utc, csi_json FROM csi_frame "
+                 "WHERE received_at_utc >= ? ORDER BY received_at_utc ASC")
+        cursor.execute(query, (window_start_str,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        iq, keep = decode_csi_json([row[1] for row in rows], CSI_LEN)
+        timestamps = [rows[i][0] for i in keep]
+        amplitude = iq_to_amplitude(iq)
+
+    if len(timestamps) == 0:
         return now, 0.0, 0
 
-    # 转复数
-    complex_signals = csi_to_complex_v2(csi_signals)
-    dt_list = []
-    for t in timestamps:
-        try:
-            if "T" in t:
-                t_clean = t.split('.')[0].replace("T", " ")
-                dt_elem = datetime.strptime(t_clean, "%Y-%m-%d %H:%M:%S")
-            else:
-                dt_elem = datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
-        except Exception as e:
-            print("Error parsing time", t, e)
-            continue
-        dt_list.append(dt_elem)
+    fs, avg_bpm_int, _ = estimate_bpm_from_amplitude(timestamps, amplitude)
+    return now, fs, avg_bpm_int
 
-    duration = (dt_list[-1] - dt_list[0]).total_seconds()
+
+def resample_uniform(csi_ts, amplitude):
+    """
+    按设备侧 csi_timestamp（微秒，uint32 回绕）把振幅矩阵线性插值到等间隔网格上，
+    填补丢帧造成的缺口。返回 (fs, resampled)；时间戳倒退（设备重启）时返回 None。
+    """
+    ts = np.asarray(csi_ts, dtype=np.int64)
+    if len(ts) < 2:
+        return None
+    d = np.diff(ts) % (1 << 32)
+    if np.any(d == 0) or np.any(d > (1 << 31)):
+        return None
+    t = np.concatenate([[0], np.cumsum(d)]) / 1e6
+    interval = np.median(d) / 1e6
+    grid = np.arange(0.0, t[-1] + interval / 2, interval)
+    resampled = np.empty((len(grid), amplitude.shape[1]), dtype=np.float32)
+    for j in range(amplitude.shape[1]):
+        resampled[:, j] = np.interp(grid, t, amplitude[:, j])
+    return 1.0 / interval, resampled
+
+
+def estimate_bpm_from_amplitude(timestamps, amplitude, csi_ts=None):
+    """
+    amplitude 为 (frames × subcarriers) 振幅矩阵，对每个子载波做 ACF 估计后取中位数。
+    返回 (fs, bpm, confidence)，confidence ∈ [0, 1] 由有效子载波占比和各子载波估计的离散程度决定。
+    传入单个设备的 csi_ts 时先按设备时钟重采样，采样率不受丢帧 / 缺口影响。
+    """
+    if csi_ts is not None:
+        res = resample_uniform(csi_ts, amplitude)
+        if res is not None:
+            return _estimate_bpm(res[0], res[1])
+
+    def _parse(t):
+        if "T" in t:
+            t = t.split('.')[0].replace("T", " ")
+        return datetime.strptime(t, "%Y-%m-%d %H:%M:%S")
+
+    try:
+        duration = (_parse(timestamps[-1]) - _parse(timestamps[0])).total_seconds()
+    except ValueError as e:
+        print("Error parsing time", e)
+        return 0.0, 0, 0.0
     if duration <= 0:
         duration = 1.0
-    fs = len(dt_list) / duration
+    fs = len(timestamps) / duration
+    return _estimate_bpm(fs, amplitude)
+
 
-    n_subcarriers = complex_signals[0].shape[0]
+def _estimate_bpm(fs, amplitude):
+    # 帧数不足一个滤波窗口时 savgol_filter 会抛 ValueError
+    if amplitude.shape[0] < savgol_window(fs):
+        return fs, 0, 0.0
     bpm_list = []
-    for sub_idx in range(n_subcarriers):
-        subcarrier_series = np.array([np.abs(s[sub_idx]) for s in complex_signals])
-        if len(subcarrier_series) < 2:
-            continue
-        proc = pre_process_signal(subcarrier_series, fs)
-        bpm = estimate_bpm_acf(proc, fs)
-        if 8 <= bpm <= 30:
-            bpm_list.append(bpm)
+    if amplitude.shape[0] >= 2:
+        for sub_idx in range(amplitude.shape[1]):
+            proc = pre_process_signal(amplitude[:, sub_idx], fs)
+            bpm = estimate_bpm_acf(proc, fs)
+            if 8 <= bpm <= 30:
+                bpm_list.append(bpm)
 
     if bpm_list:
         median_bpm = np.median(bpm_list)
         avg_bpm_int = round(median_bpm)
+        q1, q3 = np.percentile(bpm_list, [25, 75])
+        share = len(bpm_list) / amplitude.shape[1]
+        confidence = float(np.clip(share * (1.0 - (q3 - q1) / median_bpm), 0.0, 1.0))
     else:
         median_bpm = 0.0
         avg_bpm_int = 0
+        confidence = 0.0
 
-    return now, fs, avg_bpm_int
+    return fs, avg_bpm_int, confidence
 
 
 def process_breathing_rate_from_db(db_path="csi_data.db", window_length_sec=15, update_interval=1):
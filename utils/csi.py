@@ -0,0 +1,139 @@
+import bisect
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# ESP32 固件每帧上报 114 个 int8（57 个子载波的 IQ）
+CSI_LEN = 114
+
+
+def decode_csi_json(csi_json_strs, length=None):
+    """
+    批量把 csi_json 字符串解析成 (frames × 2·subcarriers) 的 int16 矩阵。
+    length 为 None 时以第一条有效帧的长度为准，长度不一致或含非整数 / 越界值的帧被丢弃。
+    返回 (iq, keep)，keep 为保留下来的原始下标。
+    """
+    n = len(csi_json_strs)
+    if n == 0:
+        return np.empty((0, length or 0), dtype=np.int16), []
+    try:
+        # 快速路径：拼成一个 JSON 数组一次解析
+        lists = json.loads("[" + ",".join(csi_json_strs) + "]")
+    except (TypeError, json.JSONDecodeError):
+        lists = []
+        for s in csi_json_strs:
+            try:
+                lists.append(json.loads(s))
+            except (TypeError, json.JSONDecodeError):
+                lists.append(None)
+
+    if length is None:
+        length = next((len(a) for a in lists if isinstance(a, list) and a), 0)
+    candidates = [i for i, a in enumerate(lists) if isinstance(a, list) and len(a) == length]
+    iq = np.empty((len(candidates), length), dtype=np.int16)
+    keep = []
+    for i in candidates:
+        try:
+            iq[len(keep)] = lists[i]
+        except (TypeError, ValueError, OverflowError):
+            continue
+        keep.append(i)
+    return iq[:len(keep)], keep
+
+
+def iq_to_amplitude(iq, with_phase=False, out=None):
+    """
+    (frames × 2·subcarriers) 的 IQ 矩阵 -> float32 振幅矩阵 (frames × subcarriers)，
+    一次向量化完成；列按 real, imag 交替排列（与 csi_to_complex_v2 一致）。
+    with_phase=True 时同时返回相位矩阵。
+    """
+    iq = np.asarray(iq)
+    if iq.ndim == 1:
+        iq = iq[np.newaxis, :]
+    n_frames, n_values = iq.shape
+    n_sub = n_values // 2
+    real = iq[:, 0:2 * n_sub:2]
+    imag = iq[:, 1:2 * n_sub:2]
+    if out is None:
+        out = np.empty((n_frames, n_sub), dtype=np.float32)
+    np.hypot(real, imag, out=out, dtype=np.float32)
+    if not with_phase:
+        return out
+    phase = np.empty((n_frames, n_sub), dtype=np.float32)
+    np.arctan2(imag, real, out=phase, dtype=np.float32)
+    return out, phase
+
+
+class CsiWindow:
+    """
+    最近 max_seconds 秒 CSI 帧的共享缓存。每次 refresh 只读取 id 大于上次的新行，
+    新帧只解析、计算振幅一次，/bpm 与 /motion 从同一份振幅矩阵中按时间（和 MAC）切片。
+    """
+
+    def __init__(self, db_path="csi_data.db", max_seconds=20, length=CSI_LEN):
+        self.db_path = db_path
+        self.max_seconds = max_seconds
+        self.length = length
+        self.last_id = 0
+        self.times = []
+        self.macs = []
+        self.csi_ts = []
+        self.last_seen = {}    # mac -> 最新一帧的 id
+        self.amplitude = np.empty((0, length // 2), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def refresh(self, now=None):
+        now = now or datetime.now()
+        cutoff = (now - timedelta(seconds=self.max_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT id, received_at_utc, csi_json, mac, csi_timestamp FROM csi_frame "
+            "WHERE id > ? AND received_at_utc >= ? ORDER BY id ASC",
+            (self.last_id, cutoff)).fetchall()
+        conn.close()
+
+        if rows:
+            iq, keep = decode_csi_json([r[2] for r in rows], self.length)
+            # 解码成功后才前移 last_id，避免异常时整批行从窗口中丢失
+            self.last_id = rows[-1][0]
+            self.times.extend(rows[i][1] for i in keep)
+            self.macs.extend(rows[i][3] for i in keep)
+            self.csi_ts.extend(rows[i][4] for i in keep)
+            for row in rows:
+                self.last_seen[row[3]] = row[0]
+            self.amplitude = np.concatenate([self.amplitude, iq_to_amplitude(iq)])
+
+        # 丢弃窗口外的旧帧
+        start = bisect.bisect_left(self.times, cutoff)
+        if start:
+            del self.times[:start]
+            del self.macs[:start]
+            del self.csi_ts[:start]
+            self.amplitude = self.amplitude[start:]
+
+    def get(self, seconds, now=None, mac=None, with_csi_ts=False):
+        """
+        刷新并返回最近 seconds 秒的 (timestamps, amplitude)；指定 mac 时只返回该设备的帧。
+        with_csi_ts=True 时额外返回设备侧的 csi_timestamp 列表。
+        """
+        now = now or datetime.now()
+        with self._lock:
+            self.refresh(now)
+            since = (now - timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+            start = bisect.bisect_left(self.times, since)
+            times, amplitude, csi_ts = self.times[start:], self.amplitude[start:], self.csi_ts[start:]
+            if mac is not None:
+                mask = np.fromiter((m == mac for m in self.macs[start:]), dtype=bool, count=len(times))
+                times = [t for t, keep in zip(times, mask) if keep]
+                csi_ts = [t for t, keep in zip(csi_ts, mask) if keep]
+                amplitude = amplitude[mask]
+            if with_csi_ts:
+                return times, amplitude, csi_ts
+            return times, amplitude
+
+    def latest_id(self, mac=None):
+        """设备（或全部设备）最新一帧的 id，用于判断自上次计算后是否有新数据。"""
+        return self.last_id if mac is None else self.last_seen.get(mac, 0)
@@ -0,0 +1,249 @@
+"""
+把 csi_frame 按块流式导出为列式 Arrow / Parquet，供离线分析使用。
+每次只读取 chunk_size 行，内存占用与表大小无关；csi 列为定长 int8 列表
+(FixedSizeList<int8>[CSI_LEN])，可直接 reshape 成 (frames × 2·subcarriers)。
+
+导出到目录（按设备 device=<mac> / 小时 hour=<YYYY-mm-ddTHH> 分区）：
+    python -m utils.export csi_data.db exports/ --start "2025-05-01 00:00:00" --end "2025-05-08 00:00:00"
+
+依赖 pyarrow，只在导出时导入。
+"""
+import argparse
+import os
+import re
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+from utils.csi import CSI_LEN, decode_csi_json
+
+CHUNK_SIZE = 50000
+DT_FORMAT = "%Y-%m-%d %H:%M:%S"
+COLUMNS = ("id", "received_at_utc", "mac", "rssi", "rate", "noise_floor", "fft_gain",
+           "agc_gain", "channel", "csi_timestamp", "sig_len", "rx_state",
+           "first_word_invalid", "csi_json")
+
+
+def _pa():
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("CSI export requires pyarrow: pip install pyarrow") from e
+    return pa, pc, pq
+
+
+def check_available():
+    """pyarrow 不可用时抛出 RuntimeError；供 /export 在发送响应头之前调用。"""
+    _pa()
+    schema()
+
+
+def schema(csi_len=CSI_LEN):
+    pa, _, _ = _pa()
+    return pa.schema([
+        ("id", pa.int64()),
+        ("received_at", pa.timestamp("s")),
+        ("mac", pa.string()),
+        ("rssi", pa.int16()),
+        ("rate", pa.int16()),
+        ("noise_floor", pa.int16()),
+        ("fft_gain", pa.int16()),
+        ("agc_gain", pa.int16()),
+        ("channel", pa.int16()),
+        ("csi_timestamp", pa.int64()),
+        ("sig_len", pa.int32()),
+        ("rx_state", pa.int16()),
+        ("first_word_invalid", pa.int16()),
+        ("csi", pa.list_(pa.int8(), csi_len)),
+    ])
+
+
+def iter_chunks(db_path, start=None, end=None, mac=None, chunk_size=CHUNK_SIZE):
+    """按 id 顺序每次 fetchmany(chunk_size) 行；start / end 为 "%Y-%m-%d %H:%M:%S"，左闭右开。"""
+    where, params = [], []
+    if start:
+        where.append("received_at_utc >= ?")
+        params.append(start)
+    if end:
+        where.append("received_at_utc < ?")
+        params.append(end)
+    if mac:
+        where.append("mac = ?")
+        params.append(mac)
+    query = f"SELECT {', '.join(COLUMNS)} FROM csi_frame"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY id ASC"
+
+    # 作为 StreamingResponse 的生成器时，每次 next() 可能在线程池的不同线程上执行
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def _normalize_time(t):
+    """
+    统一成 "%Y-%m-%d %H:%M:%S"。旧数据中的 ISO "...T...%f%z" 与 parse_csi_file_v2
+    一样转成本地时间；无法解析时返回 None。
+    """
+    if isinstance(t, str) and len(t) == 19 and "T" not in t:
+        return t
+    try:
+        dt = datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%f%z")
+    except (TypeError, ValueError):
+        return None
+    return dt.astimezone().strftime(DT_FORMAT)
+
+
+def rows_to_table(rows, csi_len=CSI_LEN):
+    """
+    把一块数据库行转换成 Arrow Table。csi 长度不等于 csi_len 或接收时间无法解析的帧被丢弃，
+    返回 (table, bad_time)，bad_time 为因时间无法解析而丢弃的行数。
+    """
+    pa, pc, _ = _pa()
+    iq, keep = decode_csi_json([r[13] for r in rows], csi_len)
+    rows = [rows[i] for i in keep]
+    cols = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    sch = schema(csi_len)
+
+    csi = pa.FixedSizeListArray.from_arrays(pa.array(iq.astype(np.int8).ravel()), csi_len)
+    times = pa.array([_normalize_time(t) for t in cols[1]], pa.string())
+    received_at = pc.strptime(times, format=DT_FORMAT, unit="s", error_is_null=True)
+    arrays = [pa.array(cols[0], pa.int64()), received_at]
+    arrays += [pa.array(cols[i], sch.field(i).type) for i in range(2, 13)]
+    arrays.append(csi)
+    table = pa.Table.from_arrays(arrays, schema=sch)
+    bad_time = received_at.null_count
+    if bad_time:
+        table = table.filter(pc.is_valid(received_at))
+    return table, bad_time
+
+
+def _partition_dir(out_dir, mac, hour):
+    safe_mac = re.sub(r"[^0-9A-Za-z]", "-", mac)
+    safe_hour = hour.replace(" ", "T")
+    # 分区键不能与表中的列同名（mac），否则按 hive 分区读回时类型冲突
+    return os.path.join(out_dir, f"device={safe_mac}", f"hour={safe_hour}")
+
+
+def export_parquet(db_path, out_dir, start=None, end=None, mac=None,
+                   chunk_size=CHUNK_SIZE, csi_len=CSI_LEN):
+    """
+    流式导出到 out_dir/device=<mac>/hour=<YYYY-mm-ddTHH>/part-<n>.parquet。
+    数据按 id（即接收时间）有序，某小时的数据写完后立即关闭对应 writer，
+    同时打开的 writer 数量只与当前小时活跃的设备数有关。
+    """
+    pa, pc, pq = _pa()
+    writers = {}
+    parts = {}      # (mac, hour) -> 已打开过的文件数，乱序回到已关闭的小时时写新的 part
+    stats = {"rows": 0, "skipped": 0, "bad_time": 0, "files": 0}
+
+    try:
+        for rows in iter_chunks(db_path, start, end, mac, chunk_size):
+            table, bad_time = rows_to_table(rows, csi_len)
+            stats["skipped"] += len(rows) - table.num_rows
+            stats["bad_time"] += bad_time
+            stats["rows"] += table.num_rows
+            if table.num_rows == 0:
+                continue
+
+            hours = pc.strftime(table["received_at"], format="%Y-%m-%d %H").to_numpy(zero_copy_only=False)
+            macs = table["mac"].to_numpy(zero_copy_only=False)
+            keys = np.char.add(np.char.add(macs.astype(str), "|"), hours.astype(str))
+            uniq, first = np.unique(keys, return_index=True)
+
+            # 已经过去的小时不会再出现，先关闭其 writer
+            min_hour = hours.min()
+            for key in [k for k in writers if k[1] < min_hour]:
+                writers.pop(key).close()
+
+            for k in uniq[np.argsort(first)]:
+                m, h = k.split("|", 1)
+                part = table.filter(pa.array(keys == k))
+                key = (m, h)
+                if key not in writers:
+                    path = _partition_dir(out_dir, m, h)
+                    os.makedirs(path, exist_ok=True)
+                    n = parts.get(key, 0)
+                    parts[key] = n + 1
+                    writers[key] = pq.ParquetWriter(os.path.join(path, f"part-{n}.parquet"), table.schema)
+                    stats["files"] += 1
+                writers[key].write_table(part)
+    finally:
+        # 出错时也要关闭 writer，保证已写出的 Parquet 文件带有 footer
+        for w in writers.values():
+            w.close()
+    return stats
+
+
+class _Drain:
+    """只追加的类文件对象，write 的内容由生成器随时取走，用于 HTTP 流式响应。"""
+
+    def __init__(self):
+        self.buf = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buf.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data, self.buf = b"".join(self.buf), []
+        return data
+
+
+def stream_export(db_path, start=None, end=None, mac=None, fmt="arrow",
+                  chunk_size=CHUNK_SIZE, csi_len=CSI_LEN):
+    """
+    生成器：逐块产出 Arrow IPC stream（fmt="arrow"）或单个 Parquet 文件（fmt="parquet"）的字节，
+    每块一个 record batch / row group。pyarrow 的可用性应在开始响应前用 check_available 检查。
+    """
+    pa, _, pq = _pa()
+    sink = _Drain()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema(csi_len))
+    else:
+        writer = pa.ipc.new_stream(sink, schema(csi_len))
+
+    for rows in iter_chunks(db_path, start, end, mac, chunk_size):
+        table, _ = rows_to_table(rows, csi_len)
+        if table.num_rows:
+            writer.write_table(table)
+        data = sink.take()
+        if data:
+            yield data
+    writer.close()
+    yield sink.take()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Export csi_frame to partitioned Parquet")
+    ap.add_argument("db_path")
+    ap.add_argument("out_dir")
+    ap.add_argument("--start", default=None, help='"%%Y-%%m-%%d %%H:%%M:%%S"，包含')
+    ap.add_argument("--end", default=None, help='"%%Y-%%m-%%d %%H:%%M:%%S"，不包含')
+    ap.add_argument("--mac", default=None)
+    ap.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = ap.parse_args()
+    print(export_parquet(args.db_path, args.out_dir, args.start, args.end, args.mac, args.chunk_size))
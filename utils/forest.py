@@ -0,0 +1,122 @@
+"""
+随机森林的紧凑数组表示：把 sklearn RandomForestClassifier 的所有树拍平成
+feature / threshold / left / right / proba 几个数组存为 .npz，推理只依赖 NumPy，
+服务进程无需 import sklearn。
+
+导出（会用随机样本校验与 sklearn 的预测一致，不一致时拒绝写出）：
+    python -m utils.forest models/random_forest_csi_model.pkl models/random_forest_csi_model.npz
+
+重新训练模型后必须重新导出并一起提交 .npz，否则服务会加载旧的紧凑模型。
+"""
+import sys
+
+import numpy as np
+
+TREE_LEAF = -1
+PARITY_SAMPLES = 20000
+
+
+def export_forest(clf, path, n_samples=PARITY_SAMPLES, seed=0):
+    """
+    把训练好的 RandomForestClassifier 导出为 .npz。写出前在各特征阈值范围内
+    （向外各扩 10%）均匀采样 n_samples 个点，并加入所有分裂阈值本身，
+    CompactForest 与 clf 的预测必须完全一致，否则抛出 ValueError。
+    """
+    features, thresholds, lefts, rights, probas, roots = [], [], [], [], [], []
+    offset = 0
+    for est in clf.estimators_:
+        t = est.tree_
+        left = t.children_left.astype(np.int32)
+        right = t.children_right.astype(np.int32)
+        is_leaf = left == TREE_LEAF
+        # 子节点下标加上全局偏移，叶子保持 -1
+        left = np.where(is_leaf, TREE_LEAF, left + offset).astype(np.int32)
+        right = np.where(is_leaf, TREE_LEAF, right + offset).astype(np.int32)
+        value = t.value[:, 0, :].astype(np.float64)
+        value /= np.maximum(value.sum(axis=1, keepdims=True), 1e-12)
+
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, t.feature).astype(np.int32))
+        thresholds.append(t.threshold.astype(np.float64))
+        lefts.append(left)
+        rights.append(right)
+        probas.append(value.astype(np.float32))
+        offset += t.node_count
+
+    arrays = dict(
+        classes=np.asarray(clf.classes_),
+        roots=np.asarray(roots, dtype=np.int32),
+        feature=np.concatenate(features),
+        threshold=np.concatenate(thresholds),
+        left=np.concatenate(lefts),
+        right=np.concatenate(rights),
+        proba=np.concatenate(probas),
+    )
+    check_parity(clf, CompactForest(**arrays), n_samples, seed)
+    np.savez_compressed(path, **arrays)
+
+
+def check_parity(clf, compact, n_samples=PARITY_SAMPLES, seed=0):
+    """在阈值覆盖的特征范围内随机采样，断言两者 predict 结果逐个相同。"""
+    n_features = clf.n_features_in_
+    internal = compact.left != TREE_LEAF
+    rng = np.random.default_rng(seed)
+    X = np.empty((n_samples, n_features), dtype=np.float64)
+    for j in range(n_features):
+        thr = compact.threshold[internal & (compact.feature == j)]
+        lo, hi = (thr.min(), thr.max()) if len(thr) else (0.0, 1.0)
+        pad = 0.1 * (hi - lo) + 1e-6
+        X[:, j] = rng.uniform(lo - pad, hi + pad, n_samples)
+        # 正好落在阈值上的点最容易暴露比较方向 / 精度问题
+        k = min(len(thr), n_samples)
+        X[:k, j] = thr[:k]
+    expected = clf.predict(X)
+    got = compact.predict(X)
+    mismatch = int(np.sum(expected != got))
+    if mismatch:
+        raise ValueError(f"CompactForest disagrees with sklearn on {mismatch}/{n_samples} samples")
+
+
+class CompactForest:
+    """只依赖 NumPy 的随机森林推理，predict 与 sklearn 的结果一致。"""
+
+    def __init__(self, classes, roots, feature, threshold, left, right, proba):
+        self.classes = classes
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.proba = proba
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{k: data[k] for k in data.files})
+
+    def predict_proba(self, X):
+        # sklearn 的树在 float32 上做比较
+        X = np.asarray(X, dtype=np.float32)
+        n_samples = X.shape[0]
+        rows = np.arange(n_samples)[:, np.newaxis]
+        node = np.broadcast_to(self.roots, (n_samples, len(self.roots))).copy()
+
+        # 所有样本 × 所有树同时向下走，直到全部到达叶子
+        active = self.left[node] != TREE_LEAF
+        while active.any():
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            nxt = np.where(go_left, self.left[node], self.right[node])
+            node = np.where(active, nxt, node)
+            active = self.left[node] != TREE_LEAF
+        return self.proba[node].mean(axis=1)
+
+    def predict(self, X):
+        return self.classes[np.argmax(self.predict_proba(X), axis=1)]
+
+
+if __name__ == "__main__":
+    import pickle
+    src, dst = sys.argv[1], sys.argv[2]
+    with open(src, "rb") as f:
+        export_forest(pickle.load(f), dst)
+    print(f"Exported {src} -> {dst} (parity check passed on {PARITY_SAMPLES} samples)")
@@ -0,0 +1,143 @@
+import threading
+from collections import deque
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+TS_WRAP = 1 << 32           # csi_timestamp 是 uint32 微秒，约 71.6 分钟回绕一次
+DEDUP_WINDOW = 256          # 每个设备记住最近多少个 csi_timestamp 用于去重
+GAP_FACTOR = 3.0            # 帧间隔超过 GAP_FACTOR × 平均间隔视为丢帧
+REBOOT_BACKWARD_US = 2_000_000    # 时间戳倒退超过 2 s（且不是回绕）视为设备重启
+EWMA_ALPHA = 0.05
+MAX_EVENTS = 64             # 每个设备保留最近的缺口 / 重启事件数
+
+
+class LinkStats:
+    """单个设备的链路统计，所有更新都是 O(1)。"""
+
+    def __init__(self):
+        self.received = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.malformed = 0
+        self.other_len = 0          # csi 长度与 CSI_LEN 不同但格式正确的帧
+        self.gaps = 0
+        self.lost_estimate = 0
+        self.reboots = 0
+        self.last_ts = None
+        self.interval_us = None     # 帧间隔的 EWMA
+        self.last_seen = None
+        self.events = deque(maxlen=MAX_EVENTS)
+        self._recent = deque()
+        self._recent_set = set()
+
+    def summary(self):
+        expected = self.accepted + self.lost_estimate
+        return {
+            "received": self.received,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "malformed": self.malformed,
+            "other_len": self.other_len,
+            "gaps": self.gaps,
+            "lost_estimate": self.lost_estimate,
+            "loss_ratio": round(self.lost_estimate / expected, 4) if expected else 0.0,
+            "reboots": self.reboots,
+            "rate_hz": round(1e6 / self.interval_us, 2) if self.interval_us else 0.0,
+            "last_seen": self.last_seen,
+        }
+
+
+class IngestValidator:
+    """
+    on_message 落库前的校验：按 (mac, csi_timestamp) 在滑动窗口内去重
+    （MQTT QoS 1 会重发同一批次），检测 csi_timestamp 的缺口和设备重启，
+    并维护每个设备的计数供 /health 和分析端使用。
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.bad_payloads = 0
+        self.malformed_frames = 0   # 无法归属到设备（缺少 mac）的坏帧
+        self._lock = threading.Lock()
+
+    def _stats(self, mac):
+        if mac not in self.devices:
+            self.devices[mac] = LinkStats()
+        return self.devices[mac]
+
+    def bad_payload(self):
+        with self._lock:
+            self.bad_payloads += 1
+
+    def malformed(self, mac=None):
+        with self._lock:
+            if mac is None:
+                self.malformed_frames += 1
+            else:
+                st = self._stats(mac)
+                st.received += 1
+                st.malformed += 1
+
+    def accept(self, mac, csi_ts, received_at, other_len=False):
+        """返回 True 表示该帧应当入库；重复帧返回 False。other_len 表示 csi 长度不是 CSI_LEN。"""
+        with self._lock:
+            st = self._stats(mac)
+            st.received += 1
+            st.last_seen = received_at
+
+            if csi_ts in st._recent_set:
+                st.duplicates += 1
+                return False
+            st._recent.append(csi_ts)
+            st._recent_set.add(csi_ts)
+            if len(st._recent) > DEDUP_WINDOW:
+                st._recent_set.discard(st._recent.popleft())
+
+            # 乱序（倒退）到达的帧不移动 last_ts，否则下一帧会被误判为缺口
+            if st.last_ts is None or self._check_sequence(st, csi_ts, received_at):
+                st.last_ts = csi_ts
+            st.accepted += 1
+            if other_len:
+                st.other_len += 1
+            return True
+
+    def _check_sequence(self, st, csi_ts, received_at):
+        """更新缺口 / 重启统计；返回 False 表示该帧乱序，last_ts 不应前移。"""
+        if csi_ts < st.last_ts and st.last_ts - csi_ts > REBOOT_BACKWARD_US \
+                and st.last_ts < TS_WRAP - REBOOT_BACKWARD_US:
+            st.reboots += 1
+            st.events.append({"type": "reboot", "at": received_at, "csi_timestamp": csi_ts})
+            return True
+
+        delta = (csi_ts - st.last_ts) % TS_WRAP
+        if delta == 0 or delta > TS_WRAP // 2:
+            # 乱序到达，不参与间隔统计
+            return False
+        if st.interval_us is not None and delta > GAP_FACTOR * st.interval_us:
+            lost = int(round(delta / st.interval_us)) - 1
+            st.gaps += 1
+            st.lost_estimate += lost
+            st.events.append({"type": "gap", "at": received_at, "csi_timestamp": csi_ts,
+                              "gap_us": delta, "lost": lost})
+            return True
+        st.interval_us = delta if st.interval_us is None else \
+            (1 - EWMA_ALPHA) * st.interval_us + EWMA_ALPHA * delta
+        return True
+
+    def events(self, mac, since=None):
+        """设备最近的缺口 / 重启事件，since 为 "%Y-%m-%d %H:%M:%S" 字符串。"""
+        with self._lock:
+            st = self.devices.get(mac)
+            if st is None:
+                return []
+            return [e for e in st.events if since is None or e["at"] >= since]
+
+    def summary(self):
+        with self._lock:
+            return {
+                "bad_payloads": self.bad_payloads,
+                "malformed_frames": self.malformed_frames,
+                "devices": {mac: st.summary() for mac, st in self.devices.items()},
+                # 与 last_seen 一样使用 on_message 的上海时间
+                "generated_at": datetime.now(ZoneInfo("Asia/Shanghai")).strftime("%Y-%m-%d %H:%M:%S"),
+            }
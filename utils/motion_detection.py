@@ -1,57 +1,46 @@
 import json
 import sqlite3
 import numpy as np
-import pandas as pd
 import os, pickle
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score
 from datetime import datetime, timedelta, timezone
+from numpy.lib.stride_tricks import sliding_window_view
+from utils.csi import decode_csi_json, iq_to_amplitude
+from utils.forest import CompactForest
+# pandas / sklearn 只在训练和离线工具中按需导入，服务路径不加载
 # 配置参数
 DB_PATH = "csi_data.db"
+# 相对于仓库根目录，不依赖进程的工作目录
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+MODEL_PATH = os.path.join(MODEL_DIR, "random_forest_csi_model.pkl")
+COMPACT_MODEL_PATH = os.path.join(MODEL_DIR, "random_forest_csi_model.npz")
 WINDOW_SIZE = 5
 NUM_SUBCARRIERS = 117
 
 # 解析 CSI IQ 字符串为振幅数组
 def parse_csi_json(csi_json_str):
-    try:
-        iq_list = json.loads(csi_json_str)
-        iq_array = np.array(iq_list).reshape(-1, 2)
-        amplitude = np.sqrt(np.sum(iq_array**2, axis=1))
-        return amplitude[:NUM_SUBCARRIERS]
-    except Exception as e:
+    iq, keep = decode_csi_json([csi_json_str])
+    if not keep:
         return None
+    return iq_to_amplitude(iq)[0, :NUM_SUBCARRIERS]
 
-# 从 DataFrame 提取特征
-def extract_features_from_dataframe_train(df):
-    features = []
-    df['amplitude'] = df['data'].apply(parse_csi_json)
-    amplitudes = df['amplitude'].dropna().to_list()
-
+# 从振幅矩阵 (frames × subcarriers) 提取滑窗特征
+def extract_features_from_amplitudes(amplitudes):
+    amplitudes = amplitudes[:, :NUM_SUBCARRIERS]
     if len(amplitudes) < WINDOW_SIZE:
         return []
 
-    for i in range(len(amplitudes) - WINDOW_SIZE + 1):
-        window = np.array(amplitudes[i:i+WINDOW_SIZE])
-        mean_std = np.mean(np.std(window, axis=0))
-        max_std = np.max(np.std(window, axis=0))
-        features.append([mean_std, max_std])
-    return features
-
-def extract_features_from_dataframe_test(df):
-    features = []
-    df['amplitude'] = df['csi_json'].apply(parse_csi_json)
-    amplitudes = df['amplitude'].dropna().to_list()
+    windows = sliding_window_view(amplitudes, WINDOW_SIZE, axis=0)
+    stds = np.std(windows, axis=-1)
+    return np.column_stack([np.mean(stds, axis=1), np.max(stds, axis=1)]).tolist()
 
-    if len(amplitudes) < WINDOW_SIZE:
-        return []
+# 从 DataFrame 提取特征
+def extract_features_from_dataframe_train(df):
+    iq, _ = decode_csi_json(df['data'].dropna().to_list())
+    return extract_features_from_amplitudes(iq_to_amplitude(iq))
 
-    for i in range(len(amplitudes) - WINDOW_SIZE + 1):
-        window = np.array(amplitudes[i:i+WINDOW_SIZE])
-        mean_std = np.mean(np.std(window, axis=0))
-        max_std = np.max(np.std(window, axis=0))
-        features.append([mean_std, max_std])
-    return features
+def extract_features_from_dataframe_test(df):
+    iq, _ = decode_csi_json(df['csi_json'].dropna().to_list())
+    return extract_features_from_amplitudes(iq_to_amplitude(iq))
 
 
 # 从 SQLite 数据库加载数据
@@ -85,6 +74,7 @@ def load_from_database(seconds=30):
     """
     cursor.execute(query, (recent_time_str,))
     rows = cursor.fetchall()
+    import pandas as pd
     df = pd.DataFrame(rows, columns=["csi_json"])
     # df = pd.read_sql_query(query, conn)
     conn.close()
@@ -92,6 +82,7 @@ def load_from_database(seconds=30):
 
 # 从 CSV 文件夹加载数据并打标签
 def load_dataset_from_folder(folder_path, label):
+    import pandas as pd
     X, y = [], []
     for fname in os.listdir(folder_path):
         if not fname.endswith(".csv"):
@@ -107,22 +98,35 @@ def load_dataset_from_folder(folder_path, label):
     return X, y
 
 # 使用模型预测数据库中数据
-def predict_from_database(clf):
+def predict_from_database(clf, window=None):
     # df = load_from_database(limit=200)
-    df = load_from_database(seconds=3)
-    feats = extract_features_from_dataframe_test(df)
-    if not feats:
+    if window is not None:
+        _, amplitudes = window.get(3)
+        feats = extract_features_from_amplitudes(amplitudes)
+    else:
+        df = load_from_database(seconds=3)
+        feats = extract_features_from_dataframe_test(df)
+    res = predict_motion(clf, feats)
+    if res is None:
         print("没有有效的 CSI 数据可用于预测")
         return None
+    # print(f"\nPrediction：{'motion (true)' if res[0] else 'static (false)'}")
+    return res[0]
 
+# 对特征做多数投票，返回 (motion, confidence)，confidence 为投票的一致程度
+def predict_motion(clf, feats):
+    if len(feats) == 0:
+        return None
     preds = clf.predict(feats)
-    majority_vote = int(np.round(np.mean(preds)))
-    # print(f"\nPrediction：{'motion (true)' if majority_vote == 1 else 'static (false)'}")
-    return True if majority_vote == 1 else False
+    vote = float(np.mean(preds))
+    majority_vote = int(np.round(vote))
+    return majority_vote == 1, abs(vote - 0.5) * 2
     #print(f"[细节] 每帧预测：{preds.tolist()}")
 
 # 训练模型
 def train_model():
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import train_test_split
     X_motion, y_motion = load_dataset_from_folder("../evaluation_motion", label=1)
     X_static, y_static = load_dataset_from_folder("../evaluation_static", label=0)
     X = X_motion + X_static
@@ -139,13 +143,28 @@ def train_model():
     # acc = accuracy_score(y_test, clf.predict(X_test))
     return clf
 
-def motion_detection():
+_model = None
+
+def load_model():
+    """
+    优先加载导出的紧凑模型（只依赖 NumPy），不存在时回退到 pickle（会导入 sklearn）。
+    模型只加载一次并缓存。
+    """
+    global _model
+    if _model is None:
+        if os.path.exists(COMPACT_MODEL_PATH):
+            _model = CompactForest.load(COMPACT_MODEL_PATH)
+        else:
+            with open(MODEL_PATH, "rb") as f:
+                _model = pickle.load(f)
+    return _model
+
+def motion_detection(window=None):
     # 训练模型
     # clf = train_model()
-    with open("models/random_forest_csi_model.pkl", "rb") as f:
-        clf = pickle.load(f)
+    clf = load_model()
     if clf:
-        return predict_from_database(clf)
+        return predict_from_database(clf, window)
     else:
         print("模型加载失败")
 
@@ -0,0 +1,167 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from utils.bpm import estimate_bpm_from_amplitude
+from utils.motion_detection import extract_features_from_amplitudes, load_model, predict_motion
+
+# 窗口长度（秒）
+BPM_WINDOW_MIN = 10
+BPM_WINDOW_DEFAULT = 20
+BPM_WINDOW_MAX = 30
+MOTION_WINDOW = 3
+# 重新计算的间隔（秒），空闲 / 结果稳定时指数退避
+BPM_INTERVAL_MIN = 1.0
+BPM_INTERVAL_MAX = 10.0
+MOTION_INTERVAL_MIN = 1.0
+MOTION_INTERVAL_MAX = 3.0    # 不超过 MOTION_WINDOW，否则缓存结果会先过期
+# 自适应阈值
+HIGH_RATE_HZ = 20.0
+GOOD_CONFIDENCE = 0.7
+LOW_CONFIDENCE = 0.3
+
+
+class DeviceState:
+    """单个设备（mac）的调度状态和最近一次结果。"""
+
+    def __init__(self):
+        self.bpm_window = BPM_WINDOW_DEFAULT
+        self.bpm_interval = BPM_INTERVAL_MIN
+        self.motion_interval = MOTION_INTERVAL_MIN
+        self.next_bpm = 0.0
+        self.next_motion = 0.0
+        self.bpm_seen_id = -1
+        self.motion_seen_id = -1
+        self.bpm = None
+        self.motion = None
+        self.lock = threading.Lock()
+
+
+class AdaptiveScheduler:
+    """
+    按设备自适应窗口长度和计算频率，请求到来时只在到期且有新数据时重新计算：
+    - 检测到运动时跳过 BPM（呼吸估计无效）；
+    - 设备持续上报且结果稳定时指数退避；
+    - 采样率高且置信度好时缩短 BPM 窗口，置信度低时加长。
+    mac 为 None 表示不区分设备，使用全部帧。
+    传入 IngestValidator 时，窗口内的丢帧比例会降低 BPM 的置信度。
+    缓存的结果比窗口更旧或设备窗口内已无帧时作废，设备停止上报后返回 None。
+    每个设备一把锁，不同设备的计算互不阻塞；全局锁只保护 devices 字典。
+    """
+
+    def __init__(self, window, validator=None):
+        self.window = window
+        self.validator = validator
+        self.devices = {}
+        self._lock = threading.Lock()
+
+    def _state(self, mac):
+        with self._lock:
+            if mac not in self.devices:
+                self.devices[mac] = DeviceState()
+            return self.devices[mac]
+
+    @staticmethod
+    def _stale(result, seconds, now):
+        """结果的计算时间早于 now - seconds 时视为过期。"""
+        if result is None:
+            return True
+        since = (now - timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+        return result["timestamp"] < since
+
+    def motion(self, mac=None):
+        """返回 {"motion", "confidence", "timestamp", "frame_id"}，数据不足时返回 None。
+        frame_id 为计算时窗口内该设备最新帧的 id。"""
+        st = self._state(mac)
+        with st.lock:
+            return self._motion(mac, st)
+
+    def bpm(self, mac=None):
+        """返回 {"bpm", "sampling_rate", "confidence", "window_sec", "timestamp", "skipped", "frame_id"}。"""
+        st = self._state(mac)
+        with st.lock:
+            motion = self._motion(mac, st)
+            if motion is not None and motion["motion"]:
+                st.bpm = None
+                st.next_bpm = 0.0
+                return {"bpm": 0, "sampling_rate": 0.0, "confidence": 0.0,
+                        "window_sec": st.bpm_window, "timestamp": motion["timestamp"],
+                        "skipped": "motion", "frame_id": motion["frame_id"]}
+            return self._bpm(mac, st)
+
+    def _motion(self, mac, st):
+        mono = time.monotonic()
+        now = datetime.now()
+        if mono < st.next_motion and not self._stale(st.motion, MOTION_WINDOW, now):
+            return st.motion
+
+        times, amplitudes = self.window.get(MOTION_WINDOW, now, mac)
+        latest = self.window.latest_id(mac)
+        if len(times) == 0 or latest == st.motion_seen_id:
+            # 没有新帧：不重新计算也不退避；窗口已空或结果过期时作废
+            if len(times) == 0 or self._stale(st.motion, MOTION_WINDOW, now):
+                st.motion = None
+            st.motion_interval = MOTION_INTERVAL_MIN
+            st.next_motion = mono + st.motion_interval
+            return st.motion
+        st.motion_seen_id = latest
+
+        res = predict_motion(load_model(), extract_features_from_amplitudes(amplitudes))
+        if res is None:
+            st.motion = None
+        else:
+            moving, confidence = res
+            changed = st.motion is None or st.motion["motion"] != moving
+            if moving or changed:
+                st.motion_interval = MOTION_INTERVAL_MIN
+            else:
+                st.motion_interval = min(st.motion_interval * 2, MOTION_INTERVAL_MAX)
+            st.motion = {"motion": moving, "confidence": round(confidence, 2),
+                         "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"), "frame_id": latest}
+        st.next_motion = mono + st.motion_interval
+        return st.motion
+
+    def _bpm(self, mac, st):
+        mono = time.monotonic()
+        now = datetime.now()
+        cached_window = st.bpm["window_sec"] if st.bpm is not None else st.bpm_window
+        if mono < st.next_bpm and not self._stale(st.bpm, cached_window, now):
+            return st.bpm
+
+        timestamps, amplitude, csi_ts = self.window.get(st.bpm_window, now, mac, with_csi_ts=True)
+        latest = self.window.latest_id(mac)
+        if len(timestamps) == 0 or latest == st.bpm_seen_id:
+            # 没有新帧：不重新计算也不退避；窗口已空或结果过期时作废
+            if len(timestamps) == 0 or self._stale(st.bpm, cached_window, now):
+                st.bpm = None
+            st.bpm_interval = BPM_INTERVAL_MIN
+            st.next_bpm = mono + st.bpm_interval
+            return st.bpm
+        st.bpm_seen_id = latest
+
+        # 单设备时按设备时钟插值填补缺口；多设备混合时时间戳不可比，退回按接收时间估计
+        fs, bpm, confidence = estimate_bpm_from_amplitude(
+            timestamps, amplitude, csi_ts if mac is not None else None)
+        window_sec = st.bpm_window
+        if self.validator is not None and mac is not None:
+            lost = sum(e.get("lost", 0) for e in self.validator.events(mac, since=timestamps[0]))
+            confidence *= len(timestamps) / (len(timestamps) + lost)
+
+        # 调整下一次的窗口长度
+        if confidence >= GOOD_CONFIDENCE and fs >= HIGH_RATE_HZ:
+            st.bpm_window = max(st.bpm_window - 2, BPM_WINDOW_MIN)
+        elif confidence < LOW_CONFIDENCE:
+            st.bpm_window = min(st.bpm_window + 5, BPM_WINDOW_MAX)
+
+        # 结果稳定且可信时降低计算频率
+        stable = st.bpm is not None and st.bpm["bpm"] == bpm
+        if stable and confidence >= GOOD_CONFIDENCE:
+            st.bpm_interval = min(st.bpm_interval * 2, BPM_INTERVAL_MAX)
+        else:
+            st.bpm_interval = BPM_INTERVAL_MIN
+        st.next_bpm = mono + st.bpm_interval
+
+        st.bpm = {"bpm": bpm, "sampling_rate": round(fs, 2), "confidence": round(confidence, 2),
+                  "window_sec": window_sec, "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"),
+                  "skipped": None, "frame_id": latest}
+        return st.bpm